@@ -13,31 +13,32 @@
 #  signal on Line 1 (OPTO_OUT, the white wire, which is pulled up to 3.3V via a 1.8kOhm resistor 
 #  for each camera) so that each frame can be synchronized (DAQ should sample this at ~1kHz+).
 #
-#  Tkinter is used to provide a simple GUI to display the images, and skvideo 
-#  is used as a wrapper to ffmpeg to write H.264 compressed video quickly, using
-#  mostly default parameters (although I tried pix_fmt gray to reduce size further,
-#  but default worked better)
+#  Tkinter is used to provide a simple GUI to display the images (in its own thread), and 
+#  skvideo is used as a wrapper to ffmpeg to write H.264 compressed video with the NVENC
+#  GPU encoder. Each image's driver buffer is viewed with GetNDArray and copied into a
+#  preallocated ring buffer (so it can be released right away). The writer then copies
+#  it again into a batch buffer that is piped to ffmpeg as raw gray8 bytes, which ffmpeg
+#  converts to yuv420p for NVENC. PyAV or PyNvVideoCodec can be used instead of the
+#  ffmpeg pipe (see VIDEO_ENCODER); they copy into their own frame/NV12 staging buffers.
 #
 #  To setup, you must download an FFMPEG executable and set an environment 
 #  variable path to it (as well as setFFmpegPath function below). Other nonstandard
 #  dependencies are the FLIR Spinnaker camera driver and PySpin package (see 
 #  Spinnaker downloads), and the skvideo package. 
 #  
-#  NOTE: currently there is no check to see if readout can keep up with triggering
-#  other that a timeout warning. It is up to the user to determine if the correct number
-#  of frames are captured. Also, the "ffmpegThreads" parameter can throttle CPU usage
-#  by FFMPEG to allow other data acquistion task priority. For example, with an Intel Xeon
-#  W-2145 processor and 4 threads, CPU usage is limited to ~50-60% @ 500Hz, 320x240px,
-#  and compressed writing is close to real-time.
+#  NOTE: currently the only checks to see if readout can keep up with triggering are
+#  a timeout warning and a warning if frames were dropped because writing fell behind.
+#  It is up to the user to determine if the correct number of frames are captured.
+#  Also, the "ffmpegThreads" parameter can throttle CPU usage by FFMPEG to allow other
+#  data acquistion task priority. For example, with an Intel Xeon W-2145 processor and
+#  4 threads, CPU usage is limited to ~50-60% @ 500Hz, 320x240px, and compressed
+#  writing is close to real-time.
 #
 # TO DO:
 # (1) report potential # missed frames (maybe use counter to count Line 1 edges and write to video file)
-# (2) try using ImageEvent instead of blocking GetNextImage(timeout) call
-# (3) explicitly setup camera onboard buffer
-# (4) use multiprocess or other package to implement better parallel processing
-# (5) try FFMPEG GPU acceleration: https://developer.nvidia.com/ffmpeg
+# (2) use multiprocess or other package to implement better parallel processing
 # =============================================================================
-import PySpin, time, os, threading, queue
+import PySpin, time, os, threading, queue, collections, ctypes
 from datetime import datetime
 import tkinter as tk
 from PIL import Image, ImageTk
@@ -50,7 +51,6 @@ import skvideo.io
 SAVE_FOLDER_ROOT = 'D:/video/bottom'
 FILENAME_ROOT = 'mj_' # optional identifier
 EXPOSURE_TIME = 2000 #in microseconds
-WAIT_TIME = 0.001 #in seconds - this limits polling time and should be less than the frame rate period 
 GAIN_VALUE1 = 25 #in dB, 0-40;
 GAMMA_VALUE = 0.5 #0.25-1
 
@@ -62,6 +62,23 @@ WIDTH_OFFSET1 = 0 #round((720-IMAGE_WIDTH)/2) # X, to keep in middle of sensor
 FRAMES_TO_RECORD = 10000 #frame rate * num seconds to record; this should match # expected exposure triggers from DAQ counter output
 TRIALS_TO_RECORD = 1000 #Max number of trials
 CAM_TIMEOUT = 100 #in ms; time to wait for another image before aborting
+CAM_BUFFER_COUNT = 4 #number of host-side stream buffers; small to minimize queueing delay, but >1 to absorb USB jitter
+WRITE_QUEUE_SIZE = 32 #max # frames waiting to be compressed; if writing falls behind, oldest frames are dropped to bound memory and latency
+WRITE_BATCH_SIZE = 8 #with VIDEO_ENCODER = 'ffmpeg', # frames collected before each write to the ffmpeg pipe
+FRAME_RING_SIZE = WRITE_QUEUE_SIZE + 16 #number of preallocated frame buffers reused by image event handler; this also bounds # frames waiting to be written (across trials), further images are dropped and counted
+CAPTURE_CPU = None #optional CPU core to reserve for the image event handler thread (other threads and ffmpeg are kept off it on Linux); avoid core 0 on Windows, which handles most interrupts. None leaves scheduling to the OS
+DISPLAY_PERIOD = 50 #in ms; GUI refresh period, independent of acquisition rate
+DISPLAY_DOWNSAMPLE = 2 #show every Nth pixel in each dimension to cut GUI conversion cost
+VIDEO_ENCODER = 'ffmpeg' #'ffmpeg' pipes frames to an ffmpeg subprocess (.mp4), 'pyav' encodes in-process with PyAV (.mp4), 'nvc' feeds NVENC in-process with PyNvVideoCodec (raw .h264)
+USE_PINNED_MEMORY = False #allocate frame buffers in CUDA page-locked host memory (requires cupy) so NVENC upload is a single DMA copy
+NVC_MAPPED_INPUT = False #with VIDEO_ENCODER = 'nvc', stage frames in CUDA host-mapped memory that NVENC reads directly by device pointer, with no separate upload (requires cupy)
+
+if VIDEO_ENCODER == 'nvc':
+    import PyNvVideoCodec as nvc #only needed for direct NVENC encoding
+if VIDEO_ENCODER == 'pyav':
+    import av #only needed for in-process ffmpeg library encoding
+if USE_PINNED_MEMORY or NVC_MAPPED_INPUT:
+    import cupy as cp #only needed for pinned/mapped memory allocation
 
 # generate output video directory and filename and make sure not overwriting
 now = datetime.now()
@@ -116,11 +133,14 @@ def initCam1(cam): #function to initialize camera parameters for synchronized ca
     cam.OffsetX.SetValue(WIDTH_OFFSET1)
     cam.OffsetY.SetValue(HEIGHT_OFFSET1)
 
-    # setup FIFO buffer
+    # setup FIFO buffer (stream nodes are not QuickSpin properties, so look each up by name once)
     camTransferLayerStream = cam.GetTLStreamNodeMap()
     handling_mode1 = PySpin.CEnumerationPtr(camTransferLayerStream.GetNode('StreamBufferHandlingMode'))
-    handling_mode_entry = handling_mode1.GetEntryByName('OldestFirst')
-    handling_mode1.SetIntValue(handling_mode_entry.GetValue())
+    buffer_count_mode1 = PySpin.CEnumerationPtr(camTransferLayerStream.GetNode('StreamBufferCountMode'))
+    buffer_count1 = PySpin.CIntegerPtr(camTransferLayerStream.GetNode('StreamBufferCountManual'))
+    handling_mode1.SetIntValue(handling_mode1.GetEntryByName('OldestFirst').GetValue())
+    buffer_count_mode1.SetIntValue(buffer_count_mode1.GetEntryByName('Manual').GetValue())
+    buffer_count1.SetValue(CAM_BUFFER_COUNT)
 
     # set trigger input to Line0 (the black wire)
     cam.TriggerMode.SetValue(PySpin.TriggerMode_On)
@@ -133,58 +153,270 @@ def initCam1(cam): #function to initialize camera parameters for synchronized ca
     cam.LineSelector.SetValue(PySpin.LineSelector_Line1)
     cam.LineMode.SetValue(PySpin.LineMode_Output) 
     cam.LineSource.SetValue(PySpin.LineSource_ExposureActive) #route desired output to Line 1 (try Counter0Active or ExposureActive)
+
+def allocFrameBuffer(shape): #function to allocate a uint8 image buffer, page-locked if USE_PINNED_MEMORY
+    if USE_PINNED_MEMORY:
+        size = int(np.prod(shape))
+        mem = cp.cuda.alloc_pinned_memory(size) #numpy array below keeps a reference to this, so it stays allocated
+        return np.frombuffer(mem, dtype=np.uint8, count=size).reshape(shape)
+    return np.empty(shape, dtype=np.uint8)
+
+def allocMappedFrameBuffer(shape): #function to allocate a uint8 image buffer in CUDA host-mapped memory; returns numpy (host) and cupy (device) views of the same memory
+    size = int(np.prod(shape))
+    mem = cp.cuda.PinnedMemoryPointer(cp.cuda.PinnedMemory(size, cp.cuda.runtime.hostAllocMapped), 0)
+    hostArray = np.frombuffer(mem, dtype=np.uint8, count=size).reshape(shape)
+    devicePtr = cp.cuda.runtime.hostGetDevicePointer(mem.ptr, 0)
+    deviceArray = cp.ndarray(shape, dtype=cp.uint8, memptr=cp.cuda.MemoryPointer(cp.cuda.UnownedMemory(devicePtr, size, mem), 0)) #mem is kept as owner so it stays allocated
+    return hostArray, deviceArray
   
-def saveImage(imageWriteQueue, writer): #function to save video frames from the queue in a separate process
+class FrameRing: #preallocated frame buffers reused in order; a buffer is only reused after release(), otherwise the new frame is dropped and counted
+    def __init__(self, size):
+        self.buffers = [allocFrameBuffer((IMAGE_HEIGHT, IMAGE_WIDTH)) for n in range(size)] #preallocate frame buffers so no new arrays are allocated per frame
+        self.slotOf = {id(buffer): n for n, buffer in enumerate(self.buffers)}
+        self.inUse = [False] * size
+        self.k = 0
+        self.dropped = 0
+
+    def acquire(self): #returns next buffer in ring, or None if it still holds a frame that has not been written
+        slot = self.k % len(self.buffers)
+        if self.inUse[slot]:
+            self.dropped = self.dropped + 1
+            return None
+        self.inUse[slot] = True
+        self.k = self.k + 1
+        return self.buffers[slot]
+
+    def release(self, buffer): #call once buffer's frame has been written (or dropped)
+        self.inUse[self.slotOf[id(buffer)]] = False
+
+class FrameQueue: #lightweight queue between one producer and one consumer thread: deque append/popleft are atomic, so only an Event is needed to wake the consumer
+    def __init__(self, maxlen=None, frameRing=None): #if maxlen is set, putting to a full queue drops the oldest item (and releases it to frameRing)
+        self.frames = collections.deque()
+        self.maxlen = maxlen
+        self.frameRing = frameRing
+        self.ready = threading.Event()
+        self.dropped = 0
+
+    def put(self, item):
+        if self.maxlen is not None and len(self.frames) >= self.maxlen:
+            try:
+                droppedItem = self.frames.popleft()
+                self.dropped = self.dropped + 1
+                if self.frameRing is not None and droppedItem is not None:
+                    self.frameRing.release(droppedItem)
+            except IndexError: #consumer emptied queue in the meantime
+                pass
+        self.frames.append(item)
+        self.ready.set()
+
+    def close(self): #put end-of-queue None for the consumer; ignores maxlen so no queued frame is dropped for it
+        self.frames.append(None)
+        self.ready.set()
+
+    def get(self, timeout=None): #same behavior as queue.Queue.get, raises queue.Empty on timeout
+        while not self.frames:
+            if not self.ready.wait(timeout):
+                raise queue.Empty
+            self.ready.clear() #loop re-checks deque, so an item put just before clear is not missed
+        return self.frames.popleft()
+
+def saveImage(imageWriteQueue, movieName, frameRing): #function to start a trial's video writer and save video frames from the queue in a separate process
+    writer = createWriter(movieName) #encoder starts here, after the camera is armed; frames arriving meanwhile wait in the queue
     while True:
         dequeuedImage = imageWriteQueue.get()
         if dequeuedImage is None:
             break
         else:
             writer.writeFrame(dequeuedImage)
-            imageWriteQueue.task_done()
+            frameRing.release(dequeuedImage) #writers copy the frame, so its ring buffer can be reused
+    writer.close() #close to FFMPEG writer
 
-def camCapture(camQueue, cam, k): #function to capture images, convert to numpy, send to queue, and release from buffer in separate process
-    global tEnd
-    while True:
-        if k == 0: #wait infinitely for trigger for first image
-            image = cam.GetNextImage() #get pointer to next image in camera buffer; blocks until image arrives via USB, within infinite timeout for first frame while waiting for DAQ to start sending triggers    
+def displayImages(displayQueue): #function to run tkinter GUI in its own thread, showing the latest frame from a length-1 queue every DISPLAY_PERIOD
+    window = tk.Tk()
+    window.title("camera acquisition")
+    displayWidth = (IMAGE_WIDTH + DISPLAY_DOWNSAMPLE - 1)//DISPLAY_DOWNSAMPLE #size after taking every Nth pixel
+    displayHeight = (IMAGE_HEIGHT + DISPLAY_DOWNSAMPLE - 1)//DISPLAY_DOWNSAMPLE
+    geomStrWidth = str(displayWidth + 25)
+    geomStrHeight = str(displayHeight + 35)
+    window.geometry(geomStrWidth + 'x' + geomStrHeight) # width+25 x height+35; large enough for downsampled frame + text
+    textlbl = tk.Label(window, text="waiting for trigger...")
+    textlbl.grid(column=0, row=0)
+    displayImg = Image.new('L', (displayWidth, displayHeight)) #create image and Tk photo once and update their pixels in place
+    displayPhoto = ImageTk.PhotoImage(displayImg)
+    imglabel = tk.Label(window, image=displayPhoto) # make Label widget to hold image
+    imglabel.place(x=10, y=20) #pixels from top-left
+
+    def refresh():
+        try:
+            displayItem = displayQueue.get_nowait()
+        except queue.Empty: #no new frame since last refresh
+            window.after(DISPLAY_PERIOD, refresh)
+            return
+        if displayItem is None: #main program is done
+            window.destroy()
+            return
+        framesElapsedStr, displayImage = displayItem
+        textlbl.configure(text=framesElapsedStr)
+        displayImg.frombytes(displayImage.tobytes())
+        displayPhoto.paste(displayImg)
+        window.after(DISPLAY_PERIOD, refresh)
+
+    window.after(DISPLAY_PERIOD, refresh)
+    window.mainloop() #all tkinter calls stay on this thread
+
+def putLatest(displayQueue, item): #function to replace anything still waiting in a length-1 queue with the newest item, so stale frames are dropped
+    try:
+        displayQueue.get_nowait()
+    except queue.Empty:
+        pass
+    displayQueue.put_nowait(item)
+
+def closeWriter(imageWriteQueue, saveThread): #function to finish writing a trial's video in a separate thread, so the next trial can start right away
+    imageWriteQueue.close() #tell save thread to stop once queue is written
+    saveThread.join() #wait until compression and saving queue is done writing to disk and writer is closed
+    if imageWriteQueue.dropped > 0:
+        print('WARNING: ' + str(imageWriteQueue.dropped) + ' frames dropped because writing fell behind')
+
+class BatchedFFmpegWriter: #collects WRITE_BATCH_SIZE frames and writes them to skvideo's ffmpeg pipe in a single call; has the same writeFrame/close interface as skvideo's FFmpegWriter
+    def __init__(self, writer): #writer must already be warm started with rawvideo gray input, so its ffmpeg process is running
+        self.writer = writer
+        self.batch = np.empty((WRITE_BATCH_SIZE, IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.uint8)
+        self.b = 0
+
+    def writeFrame(self, image):
+        self.batch[self.b] = image
+        self.b = self.b + 1
+        if self.b == WRITE_BATCH_SIZE:
+            self.writer._proc.stdin.write(self.batch) #frames back to back are the same raw bytes ffmpeg would get one at a time
+            self.b = 0
+
+    def close(self):
+        if self.b > 0:
+            self.writer._proc.stdin.write(self.batch[:self.b]) #write partial last batch
+        self.writer.close()
+
+class PyAVWriter: #writes .mp4 with PyAV, which calls the ffmpeg libraries in-process (no subprocess or pipe); has the same writeFrame/close interface as skvideo's FFmpegWriter
+    def __init__(self, filename):
+        self.container = av.open(filename, 'w')
+        self.stream = self.container.add_stream('h264_nvenc', rate=25)
+        self.stream.width = IMAGE_WIDTH
+        self.stream.height = IMAGE_HEIGHT
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.options = pyavEncoderOptions
+        self.container.start_encoding() #open NVENC and write header now rather than on first frame
+
+    def writeFrame(self, image):
+        frame = av.VideoFrame.from_ndarray(image, format='gray').reformat(format='yuv420p')
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+
+    def close(self):
+        for packet in self.stream.encode(): #flush frames still inside the encoder
+            self.container.mux(packet)
+        self.container.close()
+
+class NvcWriter: #writes H.264 directly with PyNvVideoCodec (no ffmpeg pipe); has the same writeFrame/close interface as skvideo's FFmpegWriter
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.encoder = nvc.CreateEncoder(IMAGE_WIDTH, IMAGE_HEIGHT, 'NV12', not NVC_MAPPED_INPUT, **nvcEncoderConfig) #True = frames are passed in from host (CPU) memory
+        if NVC_MAPPED_INPUT:
+            self.nv12, self.encoderInput = allocMappedFrameBuffer((IMAGE_HEIGHT*3//2, IMAGE_WIDTH)) #encoder reads host writes through device view
         else:
-            try:
-                image = cam.GetNextImage(CAM_TIMEOUT) #get pointer to next image in camera buffer; blocks until image arrives via USB, within CAM_TIMEOUT
-            except: #PySpin will throw an exception upon timeout, so end gracefully
-                print(str(k) + ' frames captured')
-                tEnd = 1
-                
-                break
-        npImage = np.array(image.GetData(), dtype="uint8").reshape( (image.GetHeight(), image.GetWidth()) ); #convert PySpin ImagePtr into numpy array
-        camQueue.put(npImage)  
+            self.nv12 = allocFrameBuffer((IMAGE_HEIGHT*3//2, IMAGE_WIDTH)) #NV12 input frame: Y plane followed by interleaved UV plane
+            self.encoderInput = self.nv12
+        self.nv12[IMAGE_HEIGHT:] = 128 #constant (gray) chroma
+
+    def writeFrame(self, image):
+        self.nv12[:IMAGE_HEIGHT] = image #Mono8 pixels are the Y plane
+        self.file.write(bytearray(self.encoder.Encode(self.encoderInput))) #encoder returns bitstream as a list of bytes
+
+    def close(self):
+        self.file.write(bytearray(self.encoder.EndEncode())) #flush frames still inside the encoder
+        self.file.close()
+
+def setCaptureThreadPriority(): #function to pin the calling thread to CAPTURE_CPU and raise its priority, so encoder threads cannot delay image handling
+    if hasattr(os, 'sched_setaffinity'): #Linux
+        try:
+            os.sched_setaffinity(0, {CAPTURE_CPU}) #0 = calling thread
+        except OSError as e:
+            print('WARNING: cannot pin capture thread to CPU ' + str(CAPTURE_CPU) + ': ' + str(e))
+        try:
+            os.nice(-10) #on Linux this only changes the calling thread
+        except OSError:
+            print('WARNING: cannot raise capture thread priority without root')
+    elif os.name == 'nt':
+        kernel32 = ctypes.windll.kernel32
+        if not kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), 1 << CAPTURE_CPU): #returns 0 on failure
+            print('WARNING: cannot pin capture thread to CPU ' + str(CAPTURE_CPU))
+        if not kernel32.SetThreadPriority(kernel32.GetCurrentThread(), 15): #THREAD_PRIORITY_TIME_CRITICAL
+            print('WARNING: cannot raise capture thread priority')
+
+def createWriter(movieName): #function to create a trial's video writer with its encoder already running; called from save thread so encoder startup (~100s of ms) does not delay arming the camera
+    if VIDEO_ENCODER == 'nvc':
+        return NvcWriter(movieName + '.h264')
+    elif VIDEO_ENCODER == 'pyav':
+        return PyAVWriter(movieName + '.mp4')
+    #writer = skvideo.io.FFmpegWriter(movieName + '.mp4', outputdict={'-vcodec': 'libx264', '-crf': str(crfOut), '-threads': str(ffmpegThreads)})
+    writer = skvideo.io.FFmpegWriter(movieName + '.mp4', inputdict=ffmpegInputDict, outputdict=ffmpegOutputDict)
+    writer._warmStart(IMAGE_HEIGHT, IMAGE_WIDTH, 1, np.dtype(np.uint8)) #launch ffmpeg now; skvideo otherwise waits until the first frame is written
+    return BatchedFFmpegWriter(writer)
+
+class CamImageHandler(PySpin.ImageEventHandler): #called by Spinnaker's acquisition thread for each new image: convert to numpy, send to queue, and release from buffer
+    def __init__(self):
+        super(CamImageHandler, self).__init__()
+        self.frameRing = FrameRing(FRAME_RING_SIZE)
+        self.camQueue = None
+        self.useNDArray = hasattr(PySpin.ImagePtr, 'GetNDArray') #older PySpin versions only provide GetData
+        self.prioritySet = CAPTURE_CPU is None
+
+    def startTrial(self, camQueue): #call before BeginAcquisition to direct images to a new queue
+        self.prioritySet = CAPTURE_CPU is None #Spinnaker may use a new event thread after each BeginAcquisition
+        self.camQueue = camQueue #frameRing is kept across trials, so new images never overwrite the previous trial's frames still waiting to be written
+
+    def OnImageEvent(self, image):
+        if not self.prioritySet: #first image: this is running on Spinnaker's acquisition thread
+            self.prioritySet = True #set first so a failure is only reported once and images keep flowing
+            setCaptureThreadPriority()
+        npImage = self.frameRing.acquire() #reuse next buffer in ring
+        if npImage is None: #writing fell too far behind; drop this image rather than overwrite a queued frame
+            image.Release()
+            return
+        if self.useNDArray:
+            np.copyto(npImage, image.GetNDArray()) #GetNDArray is a numpy view of the driver's buffer, so no copy is made before this one
+        else:
+            np.copyto(npImage, np.ndarray((IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.uint8, buffer=memoryview(image.GetData()))) #view PySpin ImagePtr data directly as 2D array, then one bulk memcpy into ring buffer
         image.Release() #release from camera buffer
-        k = k + 1
-    
+        self.camQueue.put(npImage)
+
 
 # INITIALIZE CAMERAS & COMPRESSION ###########################################################################################
+if CAPTURE_CPU is not None and hasattr(os, 'sched_setaffinity'):
+    availableCpus = os.sched_getaffinity(0)
+    if CAPTURE_CPU in availableCpus and len(availableCpus) > 1:
+        os.sched_setaffinity(0, availableCpus - {CAPTURE_CPU}) #threads and ffmpeg processes started from here on inherit this, leaving CAPTURE_CPU free
+    else:
+        print('WARNING: CPU ' + str(CAPTURE_CPU) + ' cannot be reserved for capture (available CPUs: ' + str(sorted(availableCpus)) + ')')
 system = PySpin.System.GetInstance() # Get camera system
 cam_list = system.GetCameras() # Get camera list
 cam1 = cam_list[0]
 initCam1(cam1)  
+cam1Handler = CamImageHandler()
+cam1.RegisterEventHandler(cam1Handler) #images are now delivered to cam1Handler as soon as they arrive, no capture thread needed
 
 # setup output video file parameters (can try H265 in future for better compression):  
 # for some reason FFMPEG takes exponentially longer to write at nonstandard frame rates, so just use default 25fps and change elsewhere if needed
 crfOut = 23 #controls tradeoff between quality and storage, see https://trac.ffmpeg.org/wiki/Encode/H.264 
-ffmpegThreads = 20 #this controls tradeoff between CPU usage and memory usage; video writes can take a long time if this value is low
+ffmpegThreads = 4 #this controls tradeoff between CPU usage and memory usage; with NVENC, ffmpeg's CPU threads only convert gray to yuv420p, so few are needed and more cores stay free for capture
 #crfOut = 18 #this should look nearly lossless
+ffmpegInputDict = {'-f': 'rawvideo', '-pix_fmt': 'gray', '-s': str(IMAGE_WIDTH) + 'x' + str(IMAGE_HEIGHT), '-r': '25'} #pipe raw Mono8 frames (1 byte/pixel) straight to ffmpeg, no RGB conversion
+ffmpegOutputDict = {'-vcodec': 'h264_nvenc', '-preset': 'p1', '-tune': 'll', '-rc': 'cbr', '-b:v': '20M', '-g': '60', '-bf': '0', '-pix_fmt': 'yuv420p', '-threads': str(ffmpegThreads)} #fastest NVENC preset with low-latency tuning and no B-frames so encoding keeps up in real time (p7 is slowest/highest quality)
+nvcEncoderConfig = {'codec': 'h264', 'preset': 'P1', 'tuning_info': 'low_latency', 'rc': 'cbr', 'bitrate': 20000000, 'fps': 25, 'gop': 60, 'bf': 0} #same settings as ffmpegOutputDict for VIDEO_ENCODER = 'nvc'
+pyavEncoderOptions = {'preset': 'p1', 'tune': 'll', 'rc': 'cbr', 'b': '20M', 'g': '60', 'bf': '0'} #same settings as ffmpegOutputDict for VIDEO_ENCODER = 'pyav'
 
-#setup tkinter GUI (non-blocking, i.e. without mainloop) to output images to screen quickly
-window = tk.Tk()
-window.title("camera acquisition")
-geomStrWidth = str(IMAGE_WIDTH + 25)
-geomStrHeight = str(IMAGE_HEIGHT + 35)
-window.geometry(geomStrWidth + 'x' + geomStrHeight) # 2x width+25 x height+35; large enough for frames from 2 cameras + text
-textlbl = tk.Label(window, text="waiting for trigger...")
-textlbl.grid(column=0, row=0)
-imglabel = tk.Label(window) # make Label widget to hold image
-imglabel.place(x=10, y=20) #pixels from top-left
-window.update() #update TCL tasks to make window appear
+#setup tkinter GUI in a separate thread so screen updates never block the acquisition loop
+displayQueue = queue.Queue(maxsize=1) #holds only the latest frame to display
+displayThread = threading.Thread(target=displayImages, args=(displayQueue,), daemon=True)
+displayThread.start()
 
 #############################################################################
 # start main program loop ###################################################
@@ -192,69 +424,87 @@ window.update() #update TCL tasks to make window appear
 
 try:
     print('Press Ctrl-C to exit early and save video')
+    totalStr = " of " + str(FRAMES_TO_RECORD) #precompute constant part of frame counter text
+    camTimeout = CAM_TIMEOUT/1000.0 #in seconds
+    closeThreads = [None, None] #writers alternate between 2 slots, so at most 2 NVENC sessions (consumer GPU limit) are open while one finishes
+    openTrial = None #write queue and save thread of the trial being recorded, until its writer is closed
     
     for j in range(TRIALS_TO_RECORD):
         i = 0 #frames
-        movieName1 = mouseStr + '_' + dateStr + '_bottom_' + str(j) + '.mp4'
-        #writer1 = skvideo.io.FFmpegWriter(movieName1, outputdict={'-vcodec': 'libx264', '-crf': str(crfOut), '-threads': str(ffmpegThreads)})
-        writer1 = skvideo.io.FFmpegWriter(movieName1, outputdict={'-vcodec': 'h264_nvenc', '-preset': 'p7', '-level': '6.2'})
-        imageWriteQueue1 = queue.Queue() #queue to pass images captures to separate compress and save thread
-        cam1Queue = queue.Queue()  #queue to pass images from separate cam1 acquisition thread
-        # setup separate threads to accelerate image acquisition and saving, and start immediately:
-        save1Thread = threading.Thread(target=saveImage, args=(imageWriteQueue1, writer1,))
-        cam1Thread = threading.Thread(target=camCapture, args=(cam1Queue, cam1, i,))
+        if closeThreads[j & 1] is not None:
+            closeThreads[j & 1].join() #writer from 2 trials ago must be closed before reusing its slot
+        movieName1 = mouseStr + '_' + dateStr + '_bottom_' + str(j)
+        imageWriteQueue1 = FrameQueue(WRITE_QUEUE_SIZE, cam1Handler.frameRing) #queue to pass images captures to separate compress and save thread
+        cam1Queue = FrameQueue()  #queue to pass images from cam1 image event handler; its length is bounded by FRAME_RING_SIZE
+        # setup separate thread to start the video writer and accelerate image saving, and start immediately:
+        save1Thread = threading.Thread(target=saveImage, args=(imageWriteQueue1, movieName1, cam1Handler.frameRing,))
         save1Thread.start()  
+        openTrial = (imageWriteQueue1, save1Thread)
+        cam1Handler.startTrial(cam1Queue)
         cam1.BeginAcquisition()
-        cam1Thread.start()
-        tEnd = 0
+        getFrame = cam1Queue.get #local references avoid repeated global + attribute lookups in the acquisition loop
+        putFrame = imageWriteQueue1.put
 
         for i in range(FRAMES_TO_RECORD): # main acquisition loop
                                 
-            while cam1Queue.empty(): #wait until ready in a loop
-                time.sleep(WAIT_TIME)
-                if tEnd == 1:
+            while True: #block until next image is ready
+                try:
+                    dequeuedAcq1 = getFrame(timeout=camTimeout) # get images formated as numpy from event handler queue as soon as ready
                     break
+                except queue.Empty:
+                    if i > 0: #no image within CAM_TIMEOUT, so end this trial; before first image keep waiting for DAQ to start sending triggers
+                        dequeuedAcq1 = None
+                        break
             
-            if tEnd == 1:
-                cam1.EndAcquisition()              
-                imageWriteQueue1.join() #wait until compression and saving queue is done writing to disk
-                writer1.close() #close to FFMPEG writer
+            if dequeuedAcq1 is None:
+                print(str(i) + ' frames captured')
                 break
                 
             if i == 0:
                 tStart = time.time()
                 print('Capture begins')
-               
-            dequeuedAcq1 = cam1Queue.get() # get images formated as numpy from separate process queues as soon as they are both ready
 
             #imageWriteQueue.put(enqueuedImageCombined) #put next combined image in saving queue
-            imageWriteQueue1.put(dequeuedAcq1)
+            putFrame(dequeuedAcq1)
 
             if (i+1)%20 == 0: #update screen every X frames
             #if (i+1): #update screen every X frames            
-                framesElapsedStr = "frame #: " + str(i+1) + " of " + str(FRAMES_TO_RECORD)
-                textlbl.configure(text=framesElapsedStr)
-                I = ImageTk.PhotoImage(Image.fromarray(dequeuedAcq1))
-                imglabel.configure(image=I)
-                imglabel.image = I #keep reference to image
-                window.update() #update on screen (this must be called from main thread)
+                framesElapsedStr = "frame #: " + str(i+1) + totalStr
+                putLatest(displayQueue, (framesElapsedStr, dequeuedAcq1[::DISPLAY_DOWNSAMPLE, ::DISPLAY_DOWNSAMPLE].copy())) #copy small image so ring buffer can be reused
 
             if (i+1) == (FRAMES_TO_RECORD):
                 print('Complete ' + str(i+1) + ' frames captured')
                 tEndAcq = time.time()
+
+        # end trial (after timeout or all FRAMES_TO_RECORD captured)
+        if cam1Handler.frameRing.dropped > 0:
+            print('WARNING: ' + str(cam1Handler.frameRing.dropped) + ' images dropped because all frame buffers were waiting to be written')
+            cam1Handler.frameRing.dropped = 0
+        cam1.EndAcquisition()              
+        closeThreads[j & 1] = threading.Thread(target=closeWriter, args=openTrial)
+        closeThreads[j & 1].start() #finish writing in background while waiting for next trial
+        openTrial = None
         
 # end aqcuisition loop #############################################################################################            
 
 except KeyboardInterrupt: #if user hits Ctrl-C, everything should end gracefully
     tEndAcq = time.time()
-    pass        
+    if openTrial is not None: #close the trial being recorded so its video is finalized and its save thread stops
+        closeThreads[j & 1] = threading.Thread(target=closeWriter, args=openTrial)
+        closeThreads[j & 1].start()
 
-cam1.EndAcquisition()
+if cam1.IsStreaming(): #still acquiring if Ctrl-C arrived during a trial
+    cam1.EndAcquisition()
+for closeThread in closeThreads:
+    if closeThread is not None:
+        closeThread.join() #wait for last trials to finish writing
 tEndWrite = time.time()
 print('File written at: {:.2f}sec'.format(tEndWrite - tStart))
-window.destroy() 
+putLatest(displayQueue, None) #tell GUI thread to close window
+displayThread.join()
 
 # delete all pointers/variable/etc:
+cam1.UnregisterEventHandler(cam1Handler)
 cam1.DeInit()
 del cam1
 cam_list.Clear()